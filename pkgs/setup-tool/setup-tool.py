@@ -6,16 +6,28 @@ hostname, timezone, and WiFi credentials.
 """
 
 import argparse
+import base64
+import contextlib
+import functools
+import getpass
+import grp
+import hashlib
+import json
 import os
+import pwd
 import re
 import shutil
+import stat
 import subprocess
 import sys
-from datetime import datetime
+import tempfile
+import time
+import zoneinfo
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
-from urllib.request import urlopen
-from urllib.error import URLError
+from string import Template
+from typing import Optional, Union
 
 # Output file paths
 SSH_DIR = Path("/root/.ssh")
@@ -24,12 +36,74 @@ RUNNER_DIR = Path("/var/lib/github-runner")
 RUNNER_TOKEN_FILE = RUNNER_DIR / ".runner_token"
 RUNNER_URL_FILE = RUNNER_DIR / ".runner_url"
 NIXOS_CONFIG_DIR = Path("/etc/nixos")
+STATE_DIR = Path("/var/lib/setup-tool")
+STATE_HASH_FILE = STATE_DIR / "state.hash"
 
 # Defaults
 DEFAULT_HOSTNAME = "pi4-smoke-test"
 DEFAULT_TIMEZONE = "UTC"
 DEFAULT_RUNNER_URL = "https://github.com/denysvitali/nix-hil-rpi"
 
+# Escapes for values interpolated into double-quoted Nix strings
+NIX_STRING_ESCAPES = str.maketrans({
+    "\\": "\\\\",
+    '"': '\\"',
+    "$": "\\$",
+    "\n": "\\n",
+    "\r": "\\r",
+    "\t": "\\t",
+})
+
+# Generated NixOS modules (values must be escaped with NIX_STRING_ESCAPES)
+HOSTNAME_NIX_TEMPLATE = Template('''# Generated by NixOS Raspberry Pi setup tool
+{ config, pkgs, lib, ... }:
+{
+  networking.hostName = "$hostname";
+}
+''')
+TIMEZONE_NIX_TEMPLATE = Template('''# Generated by NixOS Raspberry Pi setup tool
+{ config, pkgs, lib, ... }:
+{
+  time.timeZone = "$timezone";
+}
+''')
+WIFI_NIX_TEMPLATE = Template('''# Generated by NixOS Raspberry Pi setup tool
+{ config, pkgs, lib, ... }:
+{
+  networking.wireless = {
+    enable = true;
+    networks = {
+      "$ssid" = {
+        psk = "$password";
+      };
+    };
+  };
+}
+''')
+
+# nixos-rebuild builds the new generation into the store
+NIX_STORE_DIR = Path("/nix/store")
+
+# Numeric owners used with os.chown/os.fchown
+ROOT_OWNER = (0, 0)
+RUNNER_USER = "github-runner"
+
+# Common SSH key types
+VALID_SSH_KEY_TYPES = frozenset({
+    "ssh-rsa",
+    "ssh-ed25519",
+    "ssh-dss",
+    "ecdsa-sha2-nistp256",
+    "ecdsa-sha2-nistp384",
+    "ecdsa-sha2-nistp521",
+    "sk-ssh-ed25519@openssh.com",
+    "sk-ecdsa-sha2-nistp256@openssh.com",
+})
+
+GITHUB_USERNAME_RE = re.compile(r'^[a-zA-Z0-9-]+\Z')
+# Same rule NixOS enforces for networking.hostName
+HOSTNAME_RE = re.compile(r'^[A-Za-z0-9]([A-Za-z0-9_-]{0,61}[A-Za-z0-9])?\Z')
+
 
 def validate_ssh_key(key: str) -> tuple[bool, str]:
     """Validate SSH public key format."""
@@ -37,54 +111,92 @@ def validate_ssh_key(key: str) -> tuple[bool, str]:
     if not key:
         return False, "SSH key is empty"
 
-    # Common SSH key types
-    valid_types = [
-        "ssh-rsa",
-        "ssh-ed25519",
-        "ssh-dss",
-        "ecdsa-sha2-nistp256",
-        "ecdsa-sha2-nistp384",
-        "ecdsa-sha2-nistp521",
-        "sk-ssh-ed25519",
-        "sk-ecdsa-sha2-nistp256",
-    ]
-
     parts = key.split()
     if len(parts) < 2:
         return False, "Invalid SSH key format: must have at least type and key data"
 
     key_type = parts[0]
-    if key_type not in valid_types:
+    if key_type not in VALID_SSH_KEY_TYPES:
         return False, f"Unsupported SSH key type: {key_type}"
 
-    # Basic base64 validation (key data should be base64)
-    key_data = parts[1]
-    if not re.match(r'^[A-Za-z0-9+/]+={0,2}$', key_data):
+    # Key data is base64 and starts with the length-prefixed key type
+    try:
+        key_blob = base64.b64decode(parts[1], validate=True)
+    except ValueError:
+        # binascii.Error, or non-ASCII characters in the key data
         return False, "Invalid SSH key data (not valid base64)"
 
+    type_len = int.from_bytes(key_blob[:4], "big")
+    if key_blob[4:4 + type_len] != key_type.encode():
+        return False, f"SSH key data does not match key type: {key_type}"
+
     return True, "Valid SSH key"
 
 
-def fetch_github_keys(username: str) -> tuple[bool, str]:
-    """Fetch SSH keys from GitHub."""
-    if not username or not re.match(r'^[a-zA-Z0-9-]+$', username):
-        return False, "Invalid GitHub username"
+def collect_valid_ssh_keys(text: str, source: str) -> tuple[str, list[str]]:
+    """Return the valid SSH keys in text, one per line, and any warnings.
+
+    Blank lines and duplicates are dropped silently; invalid keys are
+    dropped with a warning naming source. The warnings are returned rather
+    than printed, since this may run on a background thread. Keys are ""
+    if none are valid.
+    """
+    valid_keys = {}
+    warnings = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line in valid_keys:
+            continue
+        is_valid, msg = validate_ssh_key(line)
+        if is_valid:
+            valid_keys[line] = None
+        else:
+            warnings.append(f"Warning: Ignoring key from {source}: {msg}")
+    return "\n".join(valid_keys), warnings
+
+
+def print_warnings(warnings: list[str]) -> None:
+    """Print warnings collected by collect_valid_ssh_keys()."""
+    for warning in warnings:
+        print(warning)
+
+
+def fetch_github_keys(username: str) -> tuple[bool, str, list[str]]:
+    """Fetch SSH keys from GitHub.
+
+    Returns success, the keys or an error message, and any warnings for
+    the caller to print.
+    """
+    if not username or not GITHUB_USERNAME_RE.match(username):
+        return False, "Invalid GitHub username", []
+
+    # urllib is only needed on this path, so keep it off the startup path
+    from urllib.error import URLError
+    from urllib.request import urlopen
 
     try:
         url = f"https://github.com/{username}.keys"
-        with urlopen(url, timeout=10) as response:
+        with urlopen(url, timeout=5) as response:
             keys = response.read().decode('utf-8').strip()
             if not keys:
-                return False, f"No SSH keys found for GitHub user: {username}"
-            return True, keys
+                return False, f"No SSH keys found for GitHub user: {username}", []
     except URLError as e:
-        return False, f"Failed to fetch keys from GitHub: {e}"
+        return False, f"Failed to fetch keys from GitHub: {e}", []
     except Exception as e:
-        return False, f"Error fetching keys: {e}"
+        return False, f"Error fetching keys: {e}", []
+
+    valid_keys, warnings = collect_valid_ssh_keys(keys, f"GitHub user {username}")
+    if not valid_keys:
+        return False, f"No valid SSH keys found for GitHub user: {username}", warnings
+    return True, valid_keys, warnings
 
 
 def read_key_from_file(path: str) -> tuple[bool, str]:
-    """Read SSH key from file."""
+    """Read SSH key from file.
+
+    The content is used as is, since authorized_keys files may prefix
+    keys with options that validate_ssh_key() does not understand.
+    """
     try:
         file_path = Path(path).expanduser()
         if not file_path.exists():
@@ -99,48 +211,243 @@ def read_key_from_file(path: str) -> tuple[bool, str]:
         return False, f"Error reading file: {e}"
 
 
-def get_timezones() -> list[str]:
-    """Get list of available timezones."""
-    try:
-        result = subprocess.run(
-            ["timedatectl", "list-timezones"],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        if result.returncode == 0:
-            return result.stdout.strip().split('\n')
-    except (subprocess.TimeoutExpired, FileNotFoundError):
-        pass
+@functools.lru_cache(maxsize=1)
+def get_known_timezones() -> frozenset[str]:
+    """Return the timezones in the system tz database.
+
+    Empty if the tz database is unavailable, in which case timezones
+    cannot be checked.
+    """
+    return frozenset(zoneinfo.available_timezones())
 
-    # Fallback to common timezones
-    return [
-        "UTC",
-        "Europe/London",
-        "Europe/Paris",
-        "Europe/Berlin",
-        "Europe/Zurich",
-        "Europe/Rome",
-        "America/New_York",
-        "America/Los_Angeles",
-        "America/Chicago",
-        "Asia/Tokyo",
-        "Asia/Shanghai",
-        "Australia/Sydney",
-    ]
+
+def is_known_timezone(timezone: str) -> bool:
+    """Check timezone against the tz database, accepting anything without one."""
+    known = get_known_timezones()
+    return not known or timezone in known
 
 
 def backup_file(path: Path) -> None:
-    """Create a backup of a file if it exists."""
-    if path.exists():
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_path = Path(f"{path}.backup.{timestamp}")
+    """Create a backup of a file if it exists.
+
+    Backups are named after a hash of their content, so backing up content
+    that was already backed up reuses the existing backup instead of adding
+    another one.
+
+    The backup is a hard link where possible, which is only safe because the
+    original is then replaced (atomic_write, unlink) rather than rewritten
+    in place.
+    """
+    try:
+        digest = hashlib.blake2b(path.read_bytes(), digest_size=4).hexdigest()
+    except FileNotFoundError:
+        return
+    backup_path = Path(f"{path}.backup.{digest}")
+    try:
+        os.link(path, backup_path)
+    except FileExistsError:
+        print(f"  Already backed up: {path} -> {backup_path}")
+        return
+    except OSError:
+        # No hard link support on this filesystem; keep the mode of secrets
         shutil.copy2(path, backup_path)
-        print(f"  Backed up: {path} -> {backup_path}")
+    print(f"  Backed up: {path} -> {backup_path}")
+
+
+@functools.lru_cache(maxsize=None)
+def lookup_owner(user: str, group: Optional[str] = None) -> Optional[tuple[int, int]]:
+    """Return the (uid, gid) for user and group, like shutil.chown would use.
+
+    Without a group, or if the group does not exist, the user's primary
+    group is used. Returns None if no such user exists. Results are cached,
+    so each name is resolved through NSS at most once per process.
+    """
+    try:
+        entry = pwd.getpwnam(user)
+    except KeyError:
+        return None
+    gid = entry.pw_gid
+    if group is not None:
+        try:
+            gid = grp.getgrnam(group).gr_gid
+        except KeyError:
+            pass
+    return entry.pw_uid, gid
+
+
+def ensure_dir(path: Path, mode: Optional[int] = None, owner: Optional[tuple[int, int]] = None) -> None:
+    """Create a directory if needed, then fix its mode and owner.
+
+    Owner and mode are only changed when they differ, so re-runs on an
+    already configured system do not touch the directory metadata.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        path.mkdir(parents=True)
+        st = os.stat(path)
+    if mode is not None and stat.S_IMODE(st.st_mode) != mode:
+        os.chmod(path, mode)
+    if owner is not None and (st.st_uid, st.st_gid) != owner:
+        os.chown(path, *owner)
+
+
+def atomic_write(path: Path, content: str, mode: int = 0o644, owner: Optional[tuple[int, int]] = None) -> None:
+    """Atomically replace path with content.
+
+    The data goes to a temporary file in the same directory, which gets its
+    mode and (uid, gid) owner set and is synced to disk before being renamed
+    over path, so readers only ever see the old or the complete new file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            # mkstemp already creates the file 0600
+            if mode != 0o600:
+                os.fchmod(f.fileno(), mode)
+            if owner is not None:
+                os.fchown(f.fileno(), *owner)
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+
+
+def fsync_dir(path: Path) -> None:
+    """Flush directory entry changes (renames, unlinks) in path to disk."""
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_if_changed(path: Path, content: str, mode: int = 0o644, owner: Optional[tuple[int, int]] = None) -> bool:
+    """Back up and atomically replace path unless it is already up to date.
 
+    A file is up to date if it holds exactly content with the given mode and
+    owner. Skipping it avoids backup churn and keeps its mtime, so Nix does
+    not see a change. Returns whether the file was written.
+    """
+    try:
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            up_to_date = (
+                stat.S_IMODE(st.st_mode) == mode
+                and (owner is None or (st.st_uid, st.st_gid) == owner)
+                and f.read() == content.encode()
+            )
+    except FileNotFoundError:
+        pass
+    else:
+        if up_to_date:
+            return False
+        backup_file(path)
+
+    atomic_write(path, content, mode=mode, owner=owner)
+    return True
+
+
+def check_nix_syntax(nix_files: dict[str, Optional[str]]) -> list[str]:
+    """Parse the staged .nix files with nix-instantiate and return any errors.
+
+    All parsers are started before any is waited on, so the files are
+    checked in parallel. Returns no errors if nix-instantiate is missing.
+    """
+    procs = {}
+    try:
+        for name, content in nix_files.items():
+            if content is not None:
+                procs[name] = (content, subprocess.Popen(
+                    ["nix-instantiate", "--parse", "-"],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                ))
+    except OSError as e:
+        for _, proc in procs.values():
+            proc.kill()
+            proc.wait()
+        if isinstance(e, FileNotFoundError):
+            return []
+        raise
+
+    errors = []
+    for name, (content, proc) in procs.items():
+        _, stderr = proc.communicate(content)
+        if proc.returncode != 0:
+            errors.append(f"{name}: {stderr.strip()}")
+    return errors
+
+
+def write_nix_files(nix_files: dict[str, Optional[str]]) -> bool:
+    """Write staged .nix files to the NixOS config directory in one pass.
+
+    nix_files maps file names to their new content, or to None if the file
+    should be removed. Previous versions are backed up first.
+    """
+    print("\nWriting NixOS configuration files...")
+
+    try:
+        # Catch syntax errors now rather than minutes into nixos-rebuild
+        errors = check_nix_syntax(nix_files)
+        if errors:
+            for error in errors:
+                print(f"  ✗ Invalid generated Nix in {error}")
+            return False
+
+        # Listing the directory doubles as the existence check
+        try:
+            with os.scandir(NIXOS_CONFIG_DIR) as entries:
+                existing = {entry.name for entry in entries}
+        except FileNotFoundError:
+            NIXOS_CONFIG_DIR.mkdir(parents=True)
+            existing = set()
+
+        changed = False
+        for name, content in nix_files.items():
+            path = NIXOS_CONFIG_DIR / name
+            if content is not None:
+                # New files need neither a comparison nor a backup
+                if name not in existing:
+                    atomic_write(path, content)
+                    written = True
+                else:
+                    written = write_if_changed(path, content)
+                if written:
+                    changed = True
+                    print(f"  ✓ Wrote {path}")
+                else:
+                    print(f"  ✓ Unchanged {path}")
+            elif name in existing:
+                backup_file(path)
+                path.unlink()
+                changed = True
+                print(f"  ✓ Removed {path}")
+
+        # One directory sync persists all of the renames and removals above
+        if changed:
+            fsync_dir(NIXOS_CONFIG_DIR)
+
+        return True
+
+    except Exception as e:
+        print(f"  ✗ Failed to write NixOS configuration files: {e}")
+        return False
+
+
+def prompt_ssh_key(pool: Optional[ThreadPoolExecutor] = None) -> tuple[bool, Union[str, Future]]:
+    """Prompt user for SSH key.
 
-def prompt_ssh_key() -> tuple[bool, str]:
-    """Prompt user for SSH key."""
+    When fetching from GitHub and a pool is given, the fetch runs in the
+    background and a Future resolving to fetch_github_keys() is returned;
+    the caller prints its warnings once it resolves.
+    """
     print("\n" + "="*60)
     print("Step 1: SSH Key Configuration")
     print("="*60)
@@ -157,8 +464,12 @@ def prompt_ssh_key() -> tuple[bool, str]:
         if not username:
             print("Error: Username required")
             return False, ""
-        print(f"Fetching keys for {username}...")
-        return fetch_github_keys(username)
+        print(f"Fetching keys for {username}...", flush=True)
+        if pool is not None:
+            return True, pool.submit(fetch_github_keys, username)
+        success, result, warnings = fetch_github_keys(username)
+        print_warnings(warnings)
+        return success, result
 
     elif choice == "2":
         print("\nPaste your SSH public key (press Enter twice when done):")
@@ -172,12 +483,12 @@ def prompt_ssh_key() -> tuple[bool, str]:
                     lines.append(line)
             except EOFError:
                 break
-        key = "\n".join(lines).strip()
-        is_valid, msg = validate_ssh_key(key)
-        if is_valid:
-            return True, key
+        keys, warnings = collect_valid_ssh_keys("\n".join(lines), "pasted input")
+        print_warnings(warnings)
+        if keys:
+            return True, keys
         else:
-            print(f"Error: {msg}")
+            print("Error: No valid SSH keys pasted")
             return False, ""
 
     elif choice == "3":
@@ -196,21 +507,20 @@ def prompt_input(prompt: str, default: str = "", required: bool = True, password
     else:
         full_prompt = f"{prompt}: "
 
-    if password:
-        import getpass
-        value = getpass.getpass(full_prompt)
-    else:
-        value = input(full_prompt)
+    while True:
+        if password:
+            value = getpass.getpass(full_prompt)
+        else:
+            value = input(full_prompt)
 
-    value = value.strip()
-    if not value:
-        value = default
+        value = value.strip()
+        if not value:
+            value = default
 
-    if required and not value:
-        print("Error: This field is required")
-        return prompt_input(prompt, default, required, password)
+        if value or not required:
+            return value
 
-    return value
+        print("Error: This field is required")
 
 
 def configure_ssh(ssh_key: str) -> bool:
@@ -219,20 +529,10 @@ def configure_ssh(ssh_key: str) -> bool:
 
     try:
         # Create .ssh directory for root
-        SSH_DIR.mkdir(parents=True, exist_ok=True)
-        os.chmod(SSH_DIR, 0o700)
-
-        # Backup existing authorized_keys
-        backup_file(AUTH_KEYS_FILE)
-
-        # Write new authorized_keys
-        with open(AUTH_KEYS_FILE, 'w') as f:
-            f.write(ssh_key + '\n')
-        os.chmod(AUTH_KEYS_FILE, 0o600)
+        ensure_dir(SSH_DIR, mode=0o700, owner=ROOT_OWNER)
 
-        # Set ownership to root (we're running as root)
-        shutil.chown(SSH_DIR, "root", "root")
-        shutil.chown(AUTH_KEYS_FILE, "root", "root")
+        # Backup existing authorized_keys and write the new one if it differs
+        write_if_changed(AUTH_KEYS_FILE, ssh_key + '\n', mode=0o600, owner=ROOT_OWNER)
 
         print("  ✓ SSH keys configured")
         return True
@@ -247,38 +547,17 @@ def configure_runner(token: str, url: str) -> bool:
     print("\n[2/6] Configuring GitHub Actions runner...")
 
     try:
-        import pwd
-
-        # Ensure runner directory exists with correct permissions
-        RUNNER_DIR.mkdir(parents=True, exist_ok=True)
-
-        # Try to set ownership to github-runner if user exists
-        try:
-            pwd.getpwnam("github-runner")
-            shutil.chown(RUNNER_DIR, "github-runner", "github-runner")
-            runner_user = "github-runner"
-            runner_group = "github-runner"
-        except KeyError:
+        # Ensure runner directory exists, owned by github-runner if it exists
+        runner_owner = lookup_owner(RUNNER_USER, RUNNER_USER)
+        ensure_dir(RUNNER_DIR, owner=runner_owner)
+        if runner_owner is None:
             # github-runner user doesn't exist, use root
-            runner_user = "root"
-            runner_group = "root"
-            print("  Note: github-runner user not found, using root")
-
-        # Backup existing files
-        backup_file(RUNNER_TOKEN_FILE)
-        backup_file(RUNNER_URL_FILE)
-
-        # Write token
-        with open(RUNNER_TOKEN_FILE, 'w') as f:
-            f.write(token + '\n')
-        os.chmod(RUNNER_TOKEN_FILE, 0o600)
-        shutil.chown(RUNNER_TOKEN_FILE, runner_user, runner_group)
-
-        # Write URL
-        with open(RUNNER_URL_FILE, 'w') as f:
-            f.write(url + '\n')
-        os.chmod(RUNNER_URL_FILE, 0o600)
-        shutil.chown(RUNNER_URL_FILE, runner_user, runner_group)
+            runner_owner = ROOT_OWNER
+            print(f"  Note: {RUNNER_USER} user not found, using root")
+
+        # Backup existing files and write token and URL if they differ
+        for path, value in ((RUNNER_TOKEN_FILE, token), (RUNNER_URL_FILE, url)):
+            write_if_changed(path, value + '\n', mode=0o600, owner=runner_owner)
 
         print("  ✓ GitHub runner configured")
         return True
@@ -288,90 +567,43 @@ def configure_runner(token: str, url: str) -> bool:
         return False
 
 
-def configure_hostname(hostname: str) -> bool:
-    """Generate hostname configuration."""
-    print("\n[3/6] Configuring hostname...")
+def configure_hostname(hostname: str, nix_files: dict[str, Optional[str]]) -> None:
+    """Generate hostname configuration into nix_files for write_nix_files().
 
-    try:
-        NIXOS_CONFIG_DIR.mkdir(parents=True, exist_ok=True)
-
-        hostname_nix = f'''# Generated by NixOS Raspberry Pi setup tool
-{{ config, pkgs, lib, ... }}:
-{{
-  networking.hostName = "{hostname}";
-}}
-'''
-        backup_file(NIXOS_CONFIG_DIR / "hostname.nix")
-        with open(NIXOS_CONFIG_DIR / "hostname.nix", 'w') as f:
-            f.write(hostname_nix)
-
-        print(f"  ✓ Hostname set to: {hostname}")
-        return True
+    hostname must already have been checked against HOSTNAME_RE.
+    """
+    print("\n[3/6] Configuring hostname...")
 
-    except Exception as e:
-        print(f"  ✗ Failed to configure hostname: {e}")
-        return False
+    nix_files["hostname.nix"] = HOSTNAME_NIX_TEMPLATE.substitute(
+        hostname=hostname.translate(NIX_STRING_ESCAPES),
+    )
+    print(f"  ✓ Hostname {hostname} staged for hostname.nix")
 
 
-def configure_timezone(timezone: str) -> bool:
-    """Generate timezone configuration."""
+def configure_timezone(timezone: str, nix_files: dict[str, Optional[str]]) -> None:
+    """Generate timezone configuration into nix_files for write_nix_files()."""
     print("\n[4/6] Configuring timezone...")
 
-    try:
-        timezone_nix = f'''# Generated by NixOS Raspberry Pi setup tool
-{{ config, pkgs, lib, ... }}:
-{{
-  time.timeZone = "{timezone}";
-}}
-'''
-        backup_file(NIXOS_CONFIG_DIR / "timezone.nix")
-        with open(NIXOS_CONFIG_DIR / "timezone.nix", 'w') as f:
-            f.write(timezone_nix)
-
-        print(f"  ✓ Timezone set to: {timezone}")
-        return True
-
-    except Exception as e:
-        print(f"  ✗ Failed to configure timezone: {e}")
-        return False
+    nix_files["timezone.nix"] = TIMEZONE_NIX_TEMPLATE.substitute(
+        timezone=timezone.translate(NIX_STRING_ESCAPES),
+    )
+    print(f"  ✓ Timezone {timezone} staged for timezone.nix")
 
 
-def configure_wifi(ssid: str, password: str, enable: bool) -> bool:
-    """Generate WiFi configuration."""
+def configure_wifi(ssid: str, password: str, enable: bool, nix_files: dict[str, Optional[str]]) -> None:
+    """Generate WiFi configuration into nix_files for write_nix_files()."""
     print("\n[5/6] Configuring WiFi...")
 
-    try:
-        if enable and ssid:
-            wifi_nix = f'''# Generated by NixOS Raspberry Pi setup tool
-{{ config, pkgs, lib, ... }}:
-{{
-  networking.wireless = {{
-    enable = true;
-    networks = {{
-      "{ssid}" = {{
-        psk = "{password}";
-      }};
-    }};
-  }};
-}}
-'''
-            backup_file(NIXOS_CONFIG_DIR / "wifi.nix")
-            with open(NIXOS_CONFIG_DIR / "wifi.nix", 'w') as f:
-                f.write(wifi_nix)
-            print(f"  ✓ WiFi configured for network: {ssid}")
-        else:
-            # Remove wifi.nix if it exists and we're not configuring WiFi
-            wifi_nix_path = NIXOS_CONFIG_DIR / "wifi.nix"
-            if wifi_nix_path.exists():
-                backup_file(wifi_nix_path)
-                wifi_nix_path.unlink()
-            print("  ✓ WiFi configuration skipped")
-
-        return True
-
-    except Exception as e:
-        print(f"  ✗ Failed to configure WiFi: {e}")
-        return False
+    if enable and ssid:
+        nix_files["wifi.nix"] = WIFI_NIX_TEMPLATE.substitute(
+            ssid=ssid.translate(NIX_STRING_ESCAPES),
+            password=password.translate(NIX_STRING_ESCAPES),
+        )
+        print(f"  ✓ WiFi network {ssid} staged for wifi.nix")
+    else:
+        # Remove wifi.nix if it exists and we're not configuring WiFi
+        nix_files["wifi.nix"] = None
+        print("  ✓ WiFi skipped, any existing wifi.nix will be removed")
 
 
 def find_nixos_config() -> Optional[Path]:
@@ -390,7 +622,7 @@ def find_nixos_config() -> Optional[Path]:
 
 def clone_nixos_config(repo_url: str = "https://github.com/denysvitali/nix-hil-rpi") -> bool:
     """Clone the NixOS configuration repository to /etc/nixos."""
-    print(f"  Cloning NixOS configuration from {repo_url}...")
+    print(f"  Cloning NixOS configuration from {repo_url}...", flush=True)
 
     try:
         # Ensure /etc/nixos exists and is empty
@@ -402,7 +634,7 @@ def clone_nixos_config(repo_url: str = "https://github.com/denysvitali/nix-hil-r
                 if response != "yes":
                     return False
                 # Backup existing directory
-                backup_path = Path(f"{NIXOS_CONFIG_DIR}.backup.{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+                backup_path = Path(f"{NIXOS_CONFIG_DIR}.backup.{time.strftime('%Y%m%d_%H%M%S')}")
                 shutil.move(NIXOS_CONFIG_DIR, backup_path)
                 print(f"  Backed up existing config to {backup_path}")
                 NIXOS_CONFIG_DIR.mkdir(parents=True, exist_ok=True)
@@ -410,14 +642,15 @@ def clone_nixos_config(repo_url: str = "https://github.com/denysvitali/nix-hil-r
             NIXOS_CONFIG_DIR.mkdir(parents=True, exist_ok=True)
 
         # Clone the repository
-        result = subprocess.run(
-            ["git", "clone", repo_url, str(NIXOS_CONFIG_DIR)],
-            capture_output=True,
-            text=True,
+        # Only the latest revision is needed; never block on a credential prompt
+        returncode, _ = run_streaming(
+            ["git", "clone", "--depth=1", "--single-branch", repo_url, str(NIXOS_CONFIG_DIR)],
+            env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},
         )
 
-        if result.returncode != 0:
-            print(f"  ✗ Failed to clone repository: {result.stderr}")
+        # git's own error output has already been shown
+        if returncode != 0:
+            print(f"  ✗ Failed to clone repository (git exited with {returncode})")
             return False
 
         print(f"  ✓ Cloned repository to {NIXOS_CONFIG_DIR}")
@@ -433,11 +666,11 @@ def get_flake_configs(flake_dir: Path) -> list[str]:
     try:
         result = subprocess.run(
             ["nix", "flake", "show", str(flake_dir), "--json"],
-            capture_output=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
             text=True,
         )
         if result.returncode == 0:
-            import json
             data = json.loads(result.stdout)
             configs = []
             if "nixosConfigurations" in data:
@@ -448,10 +681,63 @@ def get_flake_configs(flake_dir: Path) -> list[str]:
     return []
 
 
-def run_nixos_rebuild() -> bool:
-    """Run nixos-rebuild switch."""
+def run_streaming(cmd: list[str], env: Optional[dict] = None, tail_lines: int = 40) -> tuple[int, str]:
+    """Run a command, echoing its combined output live.
+
+    Returns the exit code and the last tail_lines lines of output.
+    """
+    tail = deque(maxlen=tail_lines)
+    proc = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        bufsize=1,
+        env=env,
+    )
+    try:
+        for line in proc.stdout:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+            tail.append(line)
+    except BaseException:
+        # Don't leave the command running against a pipe nobody reads
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    return returncode, "".join(tail)
+
+
+def check_rebuild_prerequisites() -> list[str]:
+    """Return the problems that would make nixos-rebuild fail outright."""
+    problems = []
+    if shutil.which("nixos-rebuild") is None:
+        problems.append("nixos-rebuild not found in PATH")
+    if not NIX_STORE_DIR.is_dir():
+        problems.append(f"{NIX_STORE_DIR} does not exist")
+    return problems
+
+
+def flake_dir_for(config_path: Path) -> Optional[Path]:
+    """Return the flake directory for a NixOS config path, if flake-based."""
+    flake_path = config_path.parent / "flake.nix" if config_path.name != "flake.nix" else config_path
+    return flake_path.parent if flake_path.exists() else None
+
+
+def run_nixos_rebuild(configs_future: Optional[Future] = None) -> tuple[bool, bool]:
+    """Run nixos-rebuild switch.
+
+    If configs_future is given, it must resolve to the output of
+    get_flake_configs() for the existing configuration directory.
+
+    Returns (success, applied): skipping the rebuild is not a failure, but
+    nothing was applied either.
+    """
     print("\n[6/6] Running nixos-rebuild switch...")
-    print("  (This may take a few minutes)")
+    print("  (This may take a few minutes)", flush=True)
 
     # Check if NixOS config exists
     config_path = find_nixos_config()
@@ -461,31 +747,33 @@ def run_nixos_rebuild() -> bool:
         if response in ("", "yes", "y"):
             if not clone_nixos_config():
                 print("  Skipping nixos-rebuild. You'll need to set up the configuration manually.")
-                return True
+                return True, False
             # Re-check for config after cloning
             config_path = find_nixos_config()
             if not config_path:
                 print("  ✗ Configuration still not found after cloning")
-                return False
+                return False, False
         else:
             print("  Skipping nixos-rebuild. You'll need to set up the configuration manually.")
-            return True  # Not a fatal error
+            return True, False  # Not a fatal error
 
     # Check if we're in a flake-based setup
-    flake_path = config_path.parent / "flake.nix" if config_path.name != "flake.nix" else config_path
-    is_flake = flake_path.exists()
+    flake_dir = flake_dir_for(config_path)
 
     try:
         # Enable experimental features needed for flakes
         env = os.environ.copy()
         env["NIX_CONFIG"] = "experimental-features = nix-command flakes"
 
-        if is_flake:
+        if flake_dir:
             # For flake-based configs, detect available configurations
-            print(f"  Using flake configuration: {flake_path.parent}")
+            print(f"  Using flake configuration: {flake_dir}")
 
-            # Get available configs
-            configs = get_flake_configs(flake_path.parent)
+            # Get available configs (possibly already fetched in the background)
+            if configs_future is not None:
+                configs = configs_future.result()
+            else:
+                configs = get_flake_configs(flake_dir)
             if configs:
                 # Prefer pi4-aarch64 for native ARM64, fallback to first available
                 config_name = None
@@ -496,50 +784,127 @@ def run_nixos_rebuild() -> bool:
                 else:
                     config_name = configs[0]
 
-                flake_target = f"{flake_path.parent}#{config_name}"
+                flake_target = f"{flake_dir}#{config_name}"
                 print(f"  Using configuration: {config_name}")
             else:
                 # Fallback to default behavior
-                flake_target = str(flake_path.parent)
+                flake_target = str(flake_dir)
 
-            result = subprocess.run(
+            returncode, output_tail = run_streaming(
                 ["nixos-rebuild", "switch", "--flake", flake_target],
-                capture_output=True,
-                text=True,
                 env=env,
             )
         else:
             # For traditional configs, ensure NIX_PATH is set
             if "NIX_PATH" not in env:
                 env["NIX_PATH"] = "nixos-config=/etc/nixos/configuration.nix:/nix/var/nix/profiles/per-user/root/channels"
-            result = subprocess.run(
+            returncode, output_tail = run_streaming(
                 ["nixos-rebuild", "switch"],
-                capture_output=True,
-                text=True,
                 env=env,
             )
 
-        if result.returncode != 0:
-            error_msg = result.stderr[-1000:] if result.stderr else "Unknown error"
+        if returncode != 0:
+            error_msg = output_tail or "Unknown error"
             print(f"  ✗ nixos-rebuild failed:\n{error_msg}")
             print("\n  You can try running manually:")
-            if is_flake:
-                print(f"    sudo nixos-rebuild switch --flake {flake_path.parent}#<config-name>")
+            if flake_dir:
+                print(f"    sudo nixos-rebuild switch --flake {flake_dir}#<config-name>")
                 print(f"  Available configs: {', '.join(configs) if 'configs' in dir() else 'unknown'}")
             else:
                 print("    sudo nixos-rebuild switch")
-            return False
+            return False, False
 
         print("  ✓ Configuration applied successfully")
-        return True
+        return True, True
 
     except Exception as e:
         print(f"  ✗ Failed to run nixos-rebuild: {e}")
+        return False, False
+
+
+def setup_state(ssh_key: str, runner_token: str, runner_url: str, hostname: str,
+                timezone: str, wifi_ssid: str, wifi_password: str) -> tuple[str, list[Path]]:
+    """Return a hash of the setup inputs and the files a run with them writes.
+
+    Each value is length-prefixed before hashing, so different inputs that
+    concatenate to the same string still hash differently.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for value in (ssh_key, runner_token, runner_url, hostname, timezone, wifi_ssid, wifi_password):
+        data = value.encode()
+        h.update(len(data).to_bytes(4, "big"))
+        h.update(data)
+
+    paths = [NIXOS_CONFIG_DIR / "hostname.nix", NIXOS_CONFIG_DIR / "timezone.nix"]
+    if ssh_key:
+        paths.append(AUTH_KEYS_FILE)
+    if runner_token:
+        paths.extend((RUNNER_TOKEN_FILE, RUNNER_URL_FILE))
+    if wifi_ssid:
+        paths.append(NIXOS_CONFIG_DIR / "wifi.nix")
+    return h.hexdigest(), paths
+
+
+def already_applied(digest: str, paths: list[Path]) -> bool:
+    """Return whether the last successful run used the same inputs and its files are still there."""
+    try:
+        if STATE_HASH_FILE.read_text().strip() != digest:
+            return False
+    except FileNotFoundError:
+        return False
+    return all(path.exists() for path in paths)
+
+
+def clear_state() -> bool:
+    """Forget the last successful run before files are rewritten.
+
+    Otherwise a run that rewrites files and then fails would leave the old
+    hash in place, and a later run with the old inputs would be skipped
+    even though the files no longer match them.
+    """
+    try:
+        STATE_HASH_FILE.unlink(missing_ok=True)
+        return True
+    except OSError as e:
+        print(f"Error: Failed to clear setup state: {e}")
         return False
 
 
-def interactive_setup():
+def save_state(digest: str) -> None:
+    """Record digest as the inputs of the last successful run."""
+    try:
+        ensure_dir(STATE_DIR, mode=0o700, owner=ROOT_OWNER)
+        atomic_write(STATE_HASH_FILE, digest + '\n', mode=0o600, owner=ROOT_OWNER)
+    except OSError as e:
+        # Only costs a full run next time
+        print(f"  Note: could not record setup state: {e}")
+
+
+def confirm_without_ssh() -> bool:
+    """Ask whether to continue when no SSH key is configured."""
+    print("\nWarning: No SSH key configured. You won't be able to log in via SSH.")
+    confirm = input("Continue without SSH? (yes/no): ").strip().lower()
+    return confirm == "yes"
+
+
+def interactive_setup(force: bool = False):
     """Run interactive setup."""
+    # Slow subprocess lookups run in the background while the user is typing
+    pool = ThreadPoolExecutor(max_workers=3)
+    try:
+        return _interactive_setup(pool, force)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _interactive_setup(pool: ThreadPoolExecutor, force: bool = False) -> int:
+    """Prompt for settings and apply them, using pool for background work.
+
+    Unless force is set, nothing is applied if the same settings were
+    already applied successfully and the files written then still exist.
+    """
+    tz_future = pool.submit(get_known_timezones)
+
     print("="*60)
     print("NixOS Raspberry Pi Post-Boot Configuration")
     print("="*60)
@@ -547,13 +912,10 @@ def interactive_setup():
     print("Press Ctrl+C at any time to cancel.\n")
 
     # SSH Key
-    ssh_success, ssh_key = prompt_ssh_key()
-    if not ssh_success:
-        print("\nWarning: No SSH key configured. You won't be able to log in via SSH.")
-        confirm = input("Continue without SSH? (yes/no): ").strip().lower()
-        if confirm != "yes":
-            print("Setup cancelled.")
-            return 1
+    ssh_success, ssh_key = prompt_ssh_key(pool)
+    if not ssh_success and not confirm_without_ssh():
+        print("Setup cancelled.")
+        return 1
 
     # Runner Token
     print("\n" + "="*60)
@@ -567,19 +929,28 @@ def interactive_setup():
     print("\n" + "="*60)
     print("Step 3: Hostname (Optional)")
     print("="*60)
-    hostname = prompt_input("Hostname", default=DEFAULT_HOSTNAME, required=False)
-    if not hostname:
-        hostname = DEFAULT_HOSTNAME
+    while True:
+        hostname = prompt_input("Hostname", default=DEFAULT_HOSTNAME, required=False)
+        if not hostname:
+            hostname = DEFAULT_HOSTNAME
+        if HOSTNAME_RE.match(hostname):
+            break
+        print(f"Error: Invalid hostname: {hostname}")
 
     # Timezone
     print("\n" + "="*60)
     print("Step 4: Timezone (Optional)")
     print("="*60)
-    timezones = get_timezones()
-    print(f"\nCommon timezones: UTC, Europe/Zurich, America/New_York")
-    timezone = prompt_input("Timezone", default=DEFAULT_TIMEZONE, required=False)
-    if not timezone:
-        timezone = DEFAULT_TIMEZONE
+    # Wait for the background load so the checks below hit the cache
+    tz_future.result()
+    print("\nCommon timezones: UTC, Europe/Zurich, America/New_York")
+    while True:
+        timezone = prompt_input("Timezone", default=DEFAULT_TIMEZONE, required=False)
+        if not timezone:
+            timezone = DEFAULT_TIMEZONE
+        if is_known_timezone(timezone):
+            break
+        print(f"Error: Unknown timezone: {timezone}")
 
     # WiFi
     print("\n" + "="*60)
@@ -594,11 +965,24 @@ def interactive_setup():
         wifi_password = prompt_input("WiFi Password", required=True, password=True)
         wifi_enable = True
 
+    # GitHub keys were fetched in the background while the user was typing
+    if isinstance(ssh_key, Future):
+        ssh_success, ssh_key, warnings = ssh_key.result()
+        print_warnings(warnings)
+        if not ssh_success:
+            print(f"\nError: {ssh_key}")
+            ssh_key = ""
+            if not confirm_without_ssh():
+                print("Setup cancelled.")
+                return 1
+
     # Summary
     print("\n" + "="*60)
     print("Configuration Summary")
     print("="*60)
-    print(f"\nSSH Key: {'Configured' if ssh_key else 'Not configured'}")
+    # Keys are one per line; count newlines rather than splitting the blob
+    ssh_key_count = ssh_key.count("\n") + 1 if ssh_key else 0
+    print(f"\nSSH Key: {f'Configured ({ssh_key_count} key(s))' if ssh_key else 'Not configured'}")
     print(f"Runner Token: {'*' * min(len(runner_token), 8) if runner_token else 'Not set'}")
     print(f"Runner URL: {runner_url}")
     print(f"Hostname: {hostname}")
@@ -611,11 +995,27 @@ def interactive_setup():
         print("Setup cancelled.")
         return 1
 
+    digest, state_paths = setup_state(ssh_key, runner_token, runner_url, hostname,
+                                      timezone, wifi_ssid, wifi_password)
+    if not force and already_applied(digest, state_paths):
+        print("\n✓ This configuration is already applied, nothing to do.")
+        print("  Run with --force to apply it again.")
+        return 0
+    if not clear_state():
+        return 1
+
     # Apply configuration
     print("\n" + "="*60)
     print("Applying Configuration")
     print("="*60)
 
+    # Detect flake configurations while the config files are being written
+    configs_future = None
+    config_path = find_nixos_config()
+    flake_dir = flake_dir_for(config_path) if config_path else None
+    if flake_dir:
+        configs_future = pool.submit(get_flake_configs, flake_dir)
+
     success = True
 
     if ssh_key:
@@ -626,27 +1026,34 @@ def interactive_setup():
         if not configure_runner(runner_token, runner_url):
             success = False
 
-    if not configure_hostname(hostname):
-        success = False
-
-    if not configure_timezone(timezone):
-        success = False
+    nix_files = {}
 
-    if not configure_wifi(wifi_ssid, wifi_password, wifi_enable):
-        success = False
+    configure_hostname(hostname, nix_files)
+    configure_timezone(timezone, nix_files)
+    configure_wifi(wifi_ssid, wifi_password, wifi_enable, nix_files)
 
-    if not run_nixos_rebuild():
+    # Rebuilding would only re-apply the old configuration
+    applied = False
+    if not write_nix_files(nix_files):
         success = False
+        print("\n[6/6] Skipping nixos-rebuild: the NixOS configuration files were not written")
+    else:
+        rebuild_ok, applied = run_nixos_rebuild(configs_future)
+        if not rebuild_ok:
+            success = False
 
     print("\n" + "="*60)
     if success:
+        # A skipped rebuild must not make the next identical run a no-op
+        if applied:
+            save_state(digest)
         print("✓ Setup completed successfully!")
         print("="*60)
         print("\nYou can now:")
         print("  • SSH into the system as root using your configured key")
         if runner_token:
             print("  • The GitHub Actions runner will be available after enabling it")
-        print("\nBackups of original files were created with .backup.<timestamp> suffix.")
+        print("\nBackups of original files were created with .backup.<hash> suffix.")
     else:
         print("✗ Setup completed with errors")
         print("="*60)
@@ -664,6 +1071,13 @@ def main():
         print("Usage: sudo setup-tool")
         return 1
 
+    # Show progress as it happens, even when piped or run under sudo
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.reconfigure(line_buffering=True)
+        except AttributeError:
+            pass
+
     parser = argparse.ArgumentParser(
         description="NixOS Raspberry Pi Post-Boot Configuration Tool"
     )
@@ -682,18 +1096,46 @@ def main():
     parser.add_argument("--wifi-ssid", help="WiFi network name")
     parser.add_argument("--wifi-password", help="WiFi password")
     parser.add_argument("--skip-wifi", action="store_true", help="Skip WiFi configuration")
+    parser.add_argument("--force", action="store_true",
+                        help="Apply and rebuild even if the same configuration was already applied")
 
     args = parser.parse_args()
 
+    # Warn before asking anything if the final step can't work; the other
+    # steps are still useful on their own
+    problems = check_rebuild_prerequisites()
+    if problems:
+        for problem in problems:
+            print(f"Warning: {problem}")
+        print("nixos-rebuild (step 6) will fail.")
+        if not args.non_interactive:
+            try:
+                confirm = input("Continue anyway? (yes/no): ").strip().lower()
+            except KeyboardInterrupt:
+                print("\n\nSetup cancelled by user.")
+                return 1
+            if confirm != "yes":
+                print("Setup cancelled.")
+                return 1
+
     if args.non_interactive:
         # Non-interactive mode
         print("Running in non-interactive mode...")
 
+        # Reject bad values before any step writes files
+        if not HOSTNAME_RE.match(args.hostname):
+            print(f"Error: Invalid hostname: {args.hostname}")
+            return 1
+        if not is_known_timezone(args.timezone):
+            print(f"Error: Unknown timezone: {args.timezone}")
+            return 1
+
         # Get SSH key
         ssh_key = ""
         if args.ssh_key:
             if args.ssh_method == "github":
-                success, ssh_key = fetch_github_keys(args.ssh_key)
+                success, ssh_key, warnings = fetch_github_keys(args.ssh_key)
+                print_warnings(warnings)
                 if not success:
                     print(f"Error: {ssh_key}")
                     return 1
@@ -709,6 +1151,19 @@ def main():
                     return 1
                 ssh_key = args.ssh_key
 
+        wifi_ssid = ""
+        wifi_password = ""
+        if not args.skip_wifi and args.wifi_ssid:
+            wifi_ssid = args.wifi_ssid
+            wifi_password = args.wifi_password or ""
+        digest, state_paths = setup_state(ssh_key, args.runner_token or "", args.runner_url,
+                                          args.hostname, args.timezone, wifi_ssid, wifi_password)
+        if not args.force and already_applied(digest, state_paths):
+            print("Configuration already applied, nothing to do.")
+            return 0
+        if not clear_state():
+            return 1
+
         # Apply configuration
         success = True
 
@@ -720,26 +1175,29 @@ def main():
             if not configure_runner(args.runner_token, args.runner_url):
                 success = False
 
-        if not configure_hostname(args.hostname):
-            success = False
+        nix_files = {}
 
-        if not configure_timezone(args.timezone):
-            success = False
+        configure_hostname(args.hostname, nix_files)
+        configure_timezone(args.timezone, nix_files)
+        configure_wifi(wifi_ssid, wifi_password, bool(wifi_ssid), nix_files)
 
-        if not args.skip_wifi and args.wifi_ssid:
-            if not configure_wifi(args.wifi_ssid, args.wifi_password or "", True):
-                success = False
-        else:
-            configure_wifi("", "", False)
-
-        if not run_nixos_rebuild():
+        # Rebuilding would only re-apply the old configuration
+        applied = False
+        if not write_nix_files(nix_files):
             success = False
+            print("\n[6/6] Skipping nixos-rebuild: the NixOS configuration files were not written")
+        else:
+            rebuild_ok, applied = run_nixos_rebuild()
+            if not rebuild_ok:
+                success = False
 
+        if success and applied:
+            save_state(digest)
         return 0 if success else 1
     else:
         # Interactive mode
         try:
-            return interactive_setup()
+            return interactive_setup(args.force)
         except KeyboardInterrupt:
             print("\n\nSetup cancelled by user.")
             return 1